@@ -0,0 +1,41 @@
+#! /bin/bash
+
+# Time the file checks of a small changeset in repositories with manifests
+# of increasing size.  The default (changelog file list) check should cost
+# the same regardless of manifest size; --strict diffs the full manifests.
+
+export HGRCPATH=
+hg version | head -1
+
+setup_author=xdono
+
+rm -rf bench
+mkdir bench || exit 1
+cp -p jcheck_test.py bench || exit 1
+cp -p jcheck.py.pub bench/jcheck.py || exit 1
+
+cd bench
+
+for n in ${SIZES:-1000 10000 100000}; do
+  hg init r$n
+  cat >r$n/.hg/hgrc <<___
+[extensions]
+jcheck_test = $(pwd)/jcheck_test.py
+___
+  mkdir r$n/.jcheck
+  echo 'project=jdk7' >r$n/.jcheck/conf
+  i=0
+  while [ $i -lt $n ]; do
+    d=r$n/src/d$(expr $i / 1000)
+    mkdir -p $d
+    seq -f "$d/f%g.java" $i $(expr $i + 999) | xargs touch
+    i=$(expr $i + 1000)
+  done
+  HGUSER=$setup_author hg ci -q -A -R r$n -m '1000000: Init
+Reviewed-by: alanb'
+  echo 'class Foo { }' >r$n/src/d0/f0.java
+  HGUSER=$setup_author hg ci -R r$n -m '1000001: Small change
+Reviewed-by: alanb'
+  echo "-- $n files: $(hg jcheck_bench -R r$n -r tip)"
+  echo "-- $n files, strict: $(hg jcheck_bench -R r$n -r tip --strict)"
+done
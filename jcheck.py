@@ -38,14 +38,37 @@
 #   [defaults]
 #   fetch = -m Merge
 #
+#   # Optionally skip the per-changeset checks for changesets that are
+#   # already present in trusted upstream repositories (local paths) or
+#   # listed in exported node-list files (one hex changeset id per line)
+#   [jcheck]
+#   trusted = /path/to/upstream/jdk /path/to/jdk-nodes.txt
+#
+#   # Optionally read the files of a changeset on several threads, which
+#   # helps large changesets in repositories on network filesystems
+#   [jcheck]
+#   threads = 8
+#
+#   # Optionally keep jcheck's caches (in .hg/jcheck) warm: after commits
+#   # and pulls, update the bugid and author indexes and pre-check the new
+#   # changesets in a background process
+#   [hooks]
+#   post-commit.jcheck = python:jcheck.warm_hook
+#   changegroup.jcheck = python:jcheck.warm_hook
+#
+#   # Verdicts are cached for strict and ordinary checks separately, so
+#   # repositories gated by jcheck.strict_hook should warm with
+#   # python:jcheck.strict_warm_hook instead
+#
 # For more information: http://openjdk.java.net/projects/code-tools/jcheck/
 
 _version = "@VERSION@"
 _date = "@DATE@"
 
-import sys, os, re, urllib, urllib2, json, inspect
+import sys, os, re, time, struct, hashlib, subprocess, threading, Queue
+import urllib, urllib2, json, inspect
 from mercurial.node import *
-from mercurial import cmdutil, context, error, patch, templater, util, utils
+from mercurial import cmdutil, context, error, hg, patch, templater, util, utils
 try:
     # Mercurial 4.3 and higher
     from mercurial import registrar
@@ -68,6 +91,13 @@ if hasattr(utils, 'dateutil'):
 else:
     dateutil_datestr = util.datestr
 
+# process-related utils moved to utils/procutil in hg 4.6
+hgexecutable = None
+if hasattr(utils, 'procutil'):
+    hgexecutable = utils.procutil.hgexecutable
+else:
+    hgexecutable = util.hgexecutable
+
 Pass = False
 Fail = True
 
@@ -83,6 +113,59 @@ def oneline(ctx):
 def is_merge(repo, rev):
     return not (-1 in repo.changelog.parentrevs(rev))
 
+def parallel_map(func, items, threads):
+    # Apply func to each item on at most the given number of threads, and
+    # return the results in the order of the items
+    results = [None] * len(items)
+    failures = [ ]
+    q = Queue.Queue()
+    for i in xrange(len(items)):
+        q.put(i)
+    def work():
+        while not failures:
+            try:
+                i = q.get_nowait()
+            except Queue.Empty:
+                return
+            try:
+                results[i] = func(items[i])
+            except Exception as e:
+                failures.append(e)
+    ts = [threading.Thread(target=work)
+          for i in xrange(min(threads, len(items)))]
+    for t in ts:
+        t.setDaemon(True)
+        t.start()
+    for t in ts:
+        t.join()
+    if failures:
+        raise failures[0]
+    return results
+
+def linked_filenode(fl, rev):
+    # Return the node of the filelog revision introduced by changeset rev,
+    # or None if none is found.  This is a fast path only: filelog linkrevs
+    # are usually, but not always, in changelog order (strip, for one, can
+    # leave them out of order), so the bisection may miss, and callers must
+    # then fall back to the manifest.  In hg < 1.1 revlogs have count()
+    # rather than len(), and linkrev() takes a node.
+    if hasattr(fl, 'count'):
+        n = fl.count()
+        linkrev = lambda i: fl.linkrev(fl.node(i))
+    else:
+        n = len(fl)
+        linkrev = fl.linkrev
+    lo, hi = 0, n
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if linkrev(mid) < rev:
+            lo = mid + 1
+        else:
+            hi = mid
+    if lo < n and linkrev(lo) == rev:
+        return fl.node(lo)
+    return None
+
 _matchall = getattr(cmdutil, 'matchall', None)
 if not _matchall:
     try:
@@ -134,13 +217,243 @@ def load_conf(root):
             raise error_Abort("%s: Missing property: %s" % (fn, pn))
     return cf
 
+# Path rules select the files examined by a check.  A rule is a
+# comma-separated list of patterns, each either a glob, in which "*" and "?"
+# do not match "/" while "**" matches anything, or a directory prefix,
+# ending in "/".  A glob without a "/" matches the last component of a path
+# in any directory.  The include and exclude rules of a check are compiled
+# into a single regular expression, in which the literal prefixes of the
+# patterns are factored into a trie, so that patterns sharing a prefix are
+# not tried one by one.
+
+def split_patterns(s):
+    return [p for p in s.split(",") if p]
+
+def glob_regex(g):
+    res = [ ]
+    i = 0
+    while i < len(g):
+        if g.startswith("**/", i):
+            res.append("(?:.*/)?")
+            i = i + 3
+        elif g.startswith("**", i):
+            res.append(".*")
+            i = i + 2
+        elif g[i] == "*":
+            res.append("[^/]*")
+            i = i + 1
+        elif g[i] == "?":
+            res.append("[^/]")
+            i = i + 1
+        else:
+            res.append(re.escape(g[i]))
+            i = i + 1
+    return "".join(res)
+
+def trie_regex(t):
+    # t maps each next character of a literal prefix to a subtrie, and ""
+    # to the regexes of the remainders of the patterns ending there
+    alts = list(t.get("", [ ]))
+    for c in sorted([c for c in t.keys() if c]):
+        alts.append(re.escape(c) + trie_regex(t[c]))
+    if len(alts) == 1:
+        return alts[0]
+    return "(?:" + "|".join(alts) + ")"
+
+def patterns_regex(patterns):
+    trie = { }
+    for p in patterns:
+        if p.endswith("/"):
+            p = p + "**"
+        elif not "/" in p:
+            p = "**/" + p
+        i = len(p)
+        for c in "*?":
+            j = p.find(c)
+            if j >= 0 and j < i:
+                i = j
+        t = trie
+        for c in p[:i]:
+            t = t.setdefault(c, { })
+        t.setdefault("", [ ]).append(glob_regex(p[i:]))
+    return trie_regex(trie)
+
+class path_matcher:
+    def __init__(self, include, exclude=[ ]):
+        # An empty include rule admits every path
+        self.include = include
+        self.exclude = exclude
+        pat = ".*"
+        if include:
+            pat = patterns_regex(include)
+        if exclude:
+            pat = "(?!%s\\Z)%s" % (patterns_regex(exclude), pat)
+        self.pattern = pat + "\\Z"
+        self.regex = re.compile(self.pattern)
+
+    def __call__(self, f):
+        return self.regex.match(f) is not None
+
+# File headers are configured by pairs of properties: header.<name>.files,
+# a path rule as described above, and header.<name>.template, the
+# name of a file in .jcheck holding the expected header, in which @YEARS@
+# stands for one or more comma-separated years.  The header must appear
+# within the first header_size bytes of each matching file.
+
+header_size = 4096
+
+def load_headers(root, cf):
+    hs = [ ]                            # (name, path_matcher, template_re)
+    for pn in sorted(cf.keys()):
+        if not (pn.startswith("header.") and pn.endswith(".files")):
+            continue
+        name = pn[len("header."):-len(".files")]
+        tn = "header.%s.template" % name
+        if not cf.has_key(tn):
+            raise error_Abort("%s: Missing property: %s"
+                              % (os.path.join(root, ".jcheck/conf"), tn))
+        fn = os.path.join(root, ".jcheck", cf[tn])
+        try:
+            f = open(fn)
+            try:
+                tmpl = f.read().rstrip("\n")
+            finally:
+                f.close()
+        except IOError as e:
+            raise error_Abort("%s: Cannot read header template: %s" % (fn, e))
+        tre = re.compile("[0-9]{4}(, [0-9]{4})*".join([re.escape(t) for t
+                                                       in tmpl.split("@YEARS@")]))
+        hs.append((name, path_matcher(split_patterns(cf[pn])), tre))
+    return hs
+
+
+# Caches
+#
+# jcheck keeps its indexes in .hg/jcheck: the bugid history ("bugids") and
+# a filter of the bugids in it ("bugids.bloom"), the author list ("authors")
+# and the verdicts of changesets that have already been checked
+# ("verdicts").  The bugid history, its filter and the verdicts cover
+# committed changesets only, never those of a pending transaction, and are
+# written only under the cache lock.  Files are replaced atomically, so
+# reading needs no lock.
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None                        # No cache locking (Windows)
+
+def cache_path(repo, name):
+    return os.path.join(repo.path, "jcheck", name)
+
+cache_locks = { }                       # Lock path -> [file, count]
+
+def lock_cache(repo, wait=True):
+    # Return True once the cache lock is held.  The lock is reentrant within
+    # a process; unlock_cache() must be called once for each success.  The
+    # repository may not be writable, in which case the caches are only read.
+    if fcntl is None:
+        return False
+    fn = cache_path(repo, "lock")
+    if fn in cache_locks:
+        cache_locks[fn][1] += 1
+        return True
+    try:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        f = open(fn, "a")
+    except (IOError, OSError):
+        return False
+    try:
+        if wait:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        else:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError:
+        f.close()
+        return False
+    cache_locks[fn] = [f, 1]
+    return True
+
+def unlock_cache(repo):
+    fn = cache_path(repo, "lock")
+    cache_locks[fn][1] -= 1
+    if cache_locks[fn][1] == 0:
+        cache_locks.pop(fn)[0].close()
+
+def write_cache(repo, name, data):
+    # Caching is best-effort: return False if the file cannot be written
+    fn = cache_path(repo, name)
+    tmp = "%s.%d" % (fn, os.getpid())
+    try:
+        if not os.path.isdir(os.path.dirname(fn)):
+            os.makedirs(os.path.dirname(fn))
+        f = open(tmp, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+        os.rename(tmp, fn)
+    except (IOError, OSError):
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        return False
+    return True
+
+def read_revmark(repo, name):
+    # Open a cache file whose first line records the last revision it covers,
+    # as "rev node".  Return (rev, file), or (None, None) if the file is
+    # missing or that revision is gone from the changelog (e.g. after a
+    # strip).
+    try:
+        f = open(cache_path(repo, name), "rb")
+    except IOError:
+        return None, None
+    try:
+        rev, node = f.readline().split()
+        rev = int(rev)
+        if rev < len(repo) and hex(repo.changelog.node(rev)) == node:
+            return rev, f
+    except ValueError:
+        pass
+    f.close()
+    return None, None
+
+def last_committed(repo, pending=None):
+    # Return the last revision that may be cached, given the first revision
+    # of a pending transaction, if any.  Shell hooks see pending changesets
+    # through HG_PENDING, without knowing where they start.
+    if os.environ.get("HG_PENDING"):
+        return -1
+    if pending is not None:
+        return pending - 1
+    return len(repo) - 1
+
 
 # Author validation
 
 author_cache = None
+author_cache_fresh = False              # Loaded from the database, not disk
+author_cache_ttl = 3600                 # Seconds a cached author list is used
 
-def load_authors(ui):
+def read_authors(ui, repo):
     global author_cache
+    fn = cache_path(repo, "authors")
+    try:
+        if time.time() - os.path.getmtime(fn) > author_cache_ttl:
+            return False
+        f = open(fn)
+        try:
+            names = json.load(f)
+        finally:
+            f.close()
+    except (IOError, OSError, ValueError):
+        return False
+    ui.debug("Loaded author names from %s\n" % fn)
+    author_cache = dict.fromkeys(names, True)
+    return True
+
+def load_authors(ui, repo=None):
+    global author_cache, author_cache_fresh
     ui.debug("Loading author names ...\n")
     u = "https://db.openjdk.java.net/people"
     author_cache = { }
@@ -155,17 +468,34 @@ def load_authors(ui):
     finally:
         if f:
             f.close()
+    author_cache_fresh = True
+    if repo:
+        write_cache(repo, "authors", json.dumps(author_cache.keys()))
 
-def validate_author(ui, an, pn):
+def validate_author(ui, an, pn, repo=None):
     if not author_cache:
-        load_authors(ui)
+        if not (repo and read_authors(ui, repo)):
+            load_authors(ui, repo)
+    if author_cache.has_key(an):
+        return True
+    if not author_cache_fresh:
+        # The cached list may predate this author
+        load_authors(ui, repo)
     return author_cache.has_key(an)
 
 
 # Whitespace and comment validation
 
 badwhite_re = re.compile("(\t)|([ \t]$)|\r", re.MULTILINE)
-normext_re = re.compile(".*\.(java|c|h|cpp|hpp)$")
+
+# Default path rule for whitespace checks, which may be replaced with
+# whitespace.include and whitespace.exclude in .jcheck/conf
+whitespace_include = ["*.java", "*.c", "*.h", "*.cpp", "*.hpp"]
+
+# Paths skipped in the initial changeset of a repository, in addition to
+# those excluded by its rules.  This is loathsome.
+initial_exclude = ["test/java/rmi**", "test/com/sun/javadoc/test**",
+                   "docs/technotes/guides**"]
 
 tag_desc_re = re.compile("Added tag [^ ]+ for changeset [0-9a-f]{12}")
 tag_re = re.compile("tip$|jdk-([1-9]([0-9]*)(\.(0|[1-9][0-9]*)){0,4})(\+(([0-9]+))|(-ga))$|jdk[4-9](u\d{1,3})?-((b\d{2,3})|(ga))$|hs\d\d(\.\d{1,2})?-b\d\d$")
@@ -177,6 +507,15 @@ def badwhite_what(m):
         return "Trailing whitespace"
     return "Carriage return (^M)"
 
+def badwhite_scan(data):
+    # Return the line number and description of the first bad whitespace
+    # in data, or None
+    if "\t" in data or "\r" in data or " \n" in data:
+        m = badwhite_re.search(data)
+        if m:
+            return data.count("\n", 0, m.start()) + 1, badwhite_what(m)
+    return None
+
 base_addr_pat = "[a-z0-9._%+-]+@[a-z0-9.-]+\.[a-z]{2,4}"
 addr_pat = ("(" + base_addr_pat + ")"
             + "|(([-_a-zA-Z0-9][-_ a-zA-Z0-9]+) +<" + base_addr_pat + ">)")
@@ -198,16 +537,27 @@ def bug_validate(ch, ctx, m, pn):
     if b in ch.cs_bugids:
         ch.error(ctx, "Bugid %d used more than once in this changeset" % b)
     ch.cs_bugids.append(b)
-    if not ch.bugids_allow_dups and b in ch.repo_bugids:
-        r = ch.repo_bugids[b]
-        if r < ctx.rev():
-            ch.error(ctx, ("Bugid %d already used in this repository, in revision %d "
-                           % (b, r)))
+    if ch.bugids_allow_dups:
+        return
+    if ch.defer_bugids:
+        # Resolved when the shards of an audit are merged
+        ch.result.errors.append({ "bugid" : b })
+        ch.cs_deferred = True
+    else:
+        r = ch.repo_bugids.get(b)
+        if r is not None and r < ctx.rev():
+            ch.error(ctx, bugid_reused(b, r))
+
+def bugid_reused(b, r):
+    return "Bugid %d already used in this repository, in revision %d " % (b, r)
 
 def rev_validate(ch, ctx, m, pn):
     ans = re.split(", *", m.group(1))
     for an in ans:
-        if not validate_author(ch.ui, an, pn) or an == "duke":
+        if not validate_author(ch.ui, an, pn, ch.repo):
+            ch.cs_unknown_authors = True
+            ch.error(ctx, "Invalid reviewer name: %s" % an)
+        elif an == "duke":
             ch.error(ctx, "Invalid reviewer name: %s" % an)
         ch.cs_reviewers.append(an)
 
@@ -241,36 +591,226 @@ def checked_comment_line(ln):
             return True
     return False
 
-def repo_bugids(ui, repo):
-    def addbugids(bugids, ctx):
-        lns = ctx.description().splitlines()
-        for ln in lns:
-            m = bug_check.match(ln)
-            if m:
-                b = int(m.group(1))
-                if not b in bugids:
-                    bugids[b] = ctx.rev()
-
-    # Should cache this, eventually
+def add_bugids(bugids, ctx):
+    lns = ctx.description().splitlines()
+    for ln in lns:
+        m = bug_check.match(ln)
+        if m:
+            b = int(m.group(1))
+            if not b in bugids:
+                bugids[b] = ctx.rev()
+
+def repo_bugids(ui, repo, pending=None):
+    # The map is cached up to the last committed revision, and caught up
+    # from there
     bugids = { }                        # bugid -> rev
-    opts = { 'rev' : ['0:tip'] }
-    ui.debug("Gathering bugids ...\n")
-    try:
-        nop = lambda c, fns: None
-        iter = cmdutil.walkchangerevs(repo, _matchall(repo), opts, nop)
-        for ctx in iter:
-            addbugids(bugids, ctx)
-    except (AttributeError, TypeError):
-        # AttributeError:  matchall does not exist in hg < 1.1
-        # TypeError:  walkchangerevs args differ in hg <= 1.3.1
-        get = util.cachefunc(lambda r: repo.changectx(r).changeset())
-        changeiter, matchfn = cmdutil.walkchangerevs(ui, repo, [], get, opts)
-        for st, rev, fns in changeiter:
-            if st == 'add':
-                node = repo.changelog.node(rev)
-                addbugids(bugids, context.changectx(repo, node))
+    last, f = read_revmark(repo, "bugids")
+    if f:
+        try:
+            try:
+                for ln in f:
+                    b, r = ln.split()
+                    bugids[int(b)] = int(r)
+            except ValueError:
+                bugids = { }
+                last = None
+        finally:
+            f.close()
+    if last is None:
+        last = -1
+    ui.debug("Gathering bugids from revision %d ...\n" % (last + 1))
+    for rev in xrange(last + 1, len(repo)):
+        add_bugids(bugids, repo[rev])
+    upto = last_committed(repo, pending)
+    if upto > last and lock_cache(repo, wait=False):
+        try:
+            write_bugid_index(repo, bugids, upto)
+        finally:
+            unlock_cache(repo)
     return bugids
 
+def write_bugid_index(repo, bugids, upto):
+    lns = ["%d %s\n" % (upto, hex(repo.changelog.node(upto)))]
+    for b, r in bugids.iteritems():
+        if r <= upto:
+            lns.append("%d %d\n" % (b, r))
+    write_cache(repo, "bugids", "".join(lns))
+
+# Most bugids of an incoming changeset are new, so they are looked up first
+# in a Bloom filter of the bugids of the committed revisions, which is
+# caught up and cached like the bugid history.  A bugid absent from the
+# filter is certainly new to those revisions; only the others need the
+# history.  The filter is sized for the bugids it holds, and rebuilt twice
+# as large once it has fewer than bloom_bits_per_bugid bits for each, so
+# that at most about one lookup in a hundred falls through to the history.
+
+bloom_min_bits = 1 << 16
+bloom_bits_per_bugid = 10
+
+def bloom_size(n):
+    # A power of two, leaving room for the history to double
+    m = bloom_min_bits
+    while m < 2 * bloom_bits_per_bugid * n:
+        m = m * 2
+    return m
+
+def bloom_positions(bits, b):
+    # Four hashes, from one digest
+    m = len(bits) << 3
+    return [h & (m - 1)
+            for h in struct.unpack("<4I", hashlib.md5("%d" % b).digest())]
+
+def bloom_add(bits, b):
+    for i in bloom_positions(bits, b):
+        bits[i >> 3] |= 1 << (i & 7)
+
+def bloom_contains(bits, b):
+    for i in bloom_positions(bits, b):
+        if not bits[i >> 3] & (1 << (i & 7)):
+            return False
+    return True
+
+def bugid_filter(ui, repo, pending=None):
+    # Return the filter and the last revision it covers.  After its
+    # revision marker, the file records the number of bugids in the filter.
+    bits = None
+    last, f = read_revmark(repo, "bugids.bloom")
+    if f:
+        try:
+            try:
+                n = int(f.readline())
+                bits = bytearray(f.read())
+            except ValueError:
+                pass
+        finally:
+            f.close()
+        if bits is not None and (len(bits) < bloom_min_bits // 8
+                                 or len(bits) & (len(bits) - 1)):
+            bits = None
+    if bits is None:
+        bits = bytearray(bloom_min_bits // 8)
+        last = -1
+        n = 0
+    upto = last_committed(repo, pending)
+    if upto <= last:
+        return bits, last
+    ui.debug("Filtering bugids from revision %d ...\n" % (last + 1))
+    bugids = { }
+    for rev in xrange(last + 1, upto + 1):
+        add_bugids(bugids, repo[rev])
+    new = [b for b in bugids if not bloom_contains(bits, b)]
+    if len(bits) * 8 < bloom_bits_per_bugid * (n + len(new)):
+        if last >= 0:
+            ui.debug("Rebuilding the bugid filter for more bugids\n")
+            for rev in xrange(0, last + 1):
+                add_bugids(bugids, repo[rev])
+        n = len(bugids)
+        bits = bytearray(bloom_size(n) // 8)
+        new = bugids.keys()
+    else:
+        n = n + len(new)
+    for b in new:
+        bloom_add(bits, b)
+    if lock_cache(repo, wait=False):
+        try:
+            write_cache(repo, "bugids.bloom", "%d %s\n%d\n%s"
+                        % (upto, hex(repo.changelog.node(upto)), n,
+                           str(bits)))
+        finally:
+            unlock_cache(repo)
+    return bits, upto
+
+class bugid_history(object):
+
+    # The revisions in which bugids were first used, as in repo_bugids(),
+    # which is called only when the filter admits a bugid.  The bugids of
+    # the revisions after those in the filter, such as those of a pending
+    # transaction, are gathered exactly.
+
+    def __init__(self, ui, repo, pending=None):
+        self.ui = ui
+        self.repo = repo
+        self.pending = pending
+        self.bits = None
+        self.recent = { }               # bugid -> rev, after the filter
+        self.bugids = None              # Full history, once loaded
+
+    def load(self):
+        self.bits, last = bugid_filter(self.ui, self.repo, self.pending)
+        for rev in xrange(last + 1, len(self.repo)):
+            add_bugids(self.recent, self.repo[rev])
+
+    def get(self, b):
+        if self.bugids is None:
+            if self.bits is None:
+                self.load()
+            if not bloom_contains(self.bits, b):
+                return self.recent.get(b)
+            self.ui.debug("Bugid %d may have been used; gathering bugids\n"
+                          % b)
+            self.bugids = repo_bugids(self.ui, self.repo, self.pending)
+        return self.bugids.get(b)
+
+
+# Trusted reference repositories
+
+class trusted_nodes(object):
+
+    # Changesets already validated when they entered an upstream repository,
+    # given either as local repository paths or as node-list files.  The
+    # sources are opened lazily, on the first membership test.
+
+    def __init__(self, ui, paths):
+        self.ui = ui
+        self.paths = paths
+        self.changelogs = None
+        self.nodes = set()
+
+    def load(self):
+        self.changelogs = [ ]
+        for p in self.paths:
+            p = util.expandpath(p)
+            if os.path.isdir(p):
+                self.ui.debug("Opening trusted repository %s\n" % p)
+                try:
+                    repo = hg.repository(self.ui, p)
+                except error.RepoError as e:
+                    raise error_Abort("[jcheck] trusted: %s: %s" % (p, e))
+                self.changelogs.append(repo.changelog)
+                continue
+            self.ui.debug("Reading trusted node list %s\n" % p)
+            try:
+                f = open(p)
+            except IOError as e:
+                raise error_Abort("[jcheck] trusted: %s: %s"
+                                  % (p, e.strerror))
+            try:
+                i = 0
+                for ln in f:
+                    i = i + 1
+                    ln = ln.split('#', 1)[0].strip()
+                    if not ln:
+                        continue
+                    if not re.match("[0-9a-fA-F]{40}$", ln):
+                        raise error_Abort("%s:%d: Invalid changeset id: %s"
+                                          % (p, i, ln))
+                    self.nodes.add(bin(ln))
+            finally:
+                f.close()
+
+    def __contains__(self, node):
+        if self.changelogs is None:
+            self.load()
+        if node in self.nodes:
+            return True
+        for cl in self.changelogs:
+            try:
+                cl.rev(node)
+                return True
+            except error.LookupError:
+                pass
+        return False
+
 
 
 # Black/white lists
@@ -499,24 +1039,119 @@ changeset_blacklist = [
 blacklist_file = '/oj/db/hg/blacklist'
 
 
+# Check registry
+#
+# A per-changeset check is a function f(checker, ctx), registered together
+# with the data it needs: changeset metadata only, the list of changed files,
+# or the contents of those files.  Checks run in order of increasing cost
+# (which defaults to the data they need), and in registration order within a
+# cost tier.  Other extensions may add checks with register_check().
+#
+# In .jcheck/conf, "checks.<name>=off" disables a check, and "failfast=true"
+# skips the remaining checks of a changeset once one of them has failed.
+# Checks that need the changed files also take path rules, in
+# "checks.<name>.include" and "checks.<name>.exclude", and ignore files that
+# the rules exclude before their filelogs or the manifest are read.
+
+NEEDS_CHANGELOG = 0                     # Changeset metadata
+NEEDS_FILES = 1                         # List of changed files
+NEEDS_CONTENTS = 2                      # Contents of changed files
+
+class Check:
+    def __init__(self, name, func, needs, cost, seq):
+        self.name = name
+        self.func = func
+        self.needs = needs
+        self.cost = cost
+        self.seq = seq
+
+check_registry = { }
+
+def register_check(name, func, needs=NEEDS_CHANGELOG, cost=None):
+    if cost is None:
+        cost = needs
+    seq = len(check_registry)
+    if name in check_registry:
+        seq = check_registry[name].seq
+    check_registry[name] = Check(name, func, needs, cost, seq)
+
+def enabled_checks(conf):
+    for pn in conf:
+        if not pn.startswith("checks."):
+            continue
+        name, rule = (pn[7:].split(".", 1) + [None])[:2]
+        if not name in check_registry:
+            raise error_Abort("Unknown check in .jcheck/conf: %s" % name)
+        if rule and (not rule in ["include", "exclude"]
+                     or check_registry[name].needs == NEEDS_CHANGELOG):
+            raise error_Abort("Unknown path rule in .jcheck/conf: %s" % pn)
+    cs = [c for c in check_registry.values()
+          if conf.get("checks." + c.name, "on") != "off"]
+    cs.sort(key=lambda c: (c.cost, c.seq))
+    return cs
+
+def check_paths(conf, name, exclude=[ ]):
+    return path_matcher(split_patterns(conf.get("checks.%s.include" % name, "")),
+                        split_patterns(conf.get("checks.%s.exclude" % name, ""))
+                        + exclude)
+
+
+# Findings for a single changeset, or for the repository as a whole when
+# rev and node are None.  Checks that were not run because the changeset
+# is whitelisted or trusted leave the reason in skipped.
+
+class Result:
+    def __init__(self, rev, node):
+        self.rev = rev
+        self.node = node
+        self.errors = [ ]
+        self.skipped = None
+
+    def failed(self):
+        return len(self.errors) > 0
+
+
+
 # Checker class
 
 class checker(object):
 
-    def __init__(self, ui, repo, strict, lax):
+    def __init__(self, ui, repo, strict, lax, pending=None, bugids=None):
         self.ui = ui
         self.repo = repo
         self.rv = Pass
-        self.checks = [c for c in checker.__dict__ if c.startswith("c_")]
-        self.checks.sort()
         self.summarized = False
-        self.repo_bugids = [ ]
+        self.quiet = False              # Record errors without printing them
+        self.result = Result(None, None)    # Findings of current changeset
+        self.repo_bugids = { }
         self.cs_bugids = [ ]            # Bugids in current changeset
         self.cs_author = None           # Author of current changeset
         self.cs_reviewers = [ ]         # Reviewers of current changeset
         self.cs_contributor = None      # Contributor of current changeset
+        self.cs_files = None            # Files changed by current changeset
+        self.cs_filenodes = { }         # ... their filenodes, once looked up
+        self.cs_heads = { }             # Heads of its files, by name
+        self.cs_failed = False          # Current changeset has failed
+        self.cs_deferred = False        # ... or may fail, once shards merge
+        self.cs_unknown_authors = False # ... or names someone not yet known
+        self.defer_bugids = False       # Defer checks for reused bugids
+        self.verdicts = None            # Cached errors, by node
+        self.record = False             # Cache verdicts of checked changesets
+        self.pending = pending          # First revision of pending transaction
         self.strict = strict
+        self.lax = lax
+        self.threads = ui.configint("jcheck", "threads", 1)
         self.conf = load_conf(repo.root)
+        self.headers = load_headers(repo.root, self.conf)
+        self.checks = enabled_checks(self.conf)
+        self.files_paths = check_paths(self.conf, "files")
+        self.initial_paths = check_paths(self.conf, "files", initial_exclude)
+        self.whitespace_paths = path_matcher(
+            split_patterns(self.conf.get("whitespace.include",
+                                         ",".join(whitespace_include))),
+            split_patterns(self.conf.get("whitespace.exclude", "")))
+        self.header_paths = check_paths(self.conf, "header")
+        self.failfast = self.conf.get("failfast") == "true"
         self.whitespace_lax = lax and not strict
         if self.conf.get("whitespace") == "lax":
             self.whitespace_lax = True
@@ -534,12 +1169,19 @@ class checker(object):
         if self.conf.get("bugids") == "ignore":
             self.bugids_ignore = True
         if not self.bugids_ignore and not self.bugids_allow_dups:
-            # only gather bug ids if we are going to use them
-            self.repo_bugids = repo_bugids(ui, repo)
+            # only gather bug ids if we are going to use them, and then
+            # only as they are looked up
+            if bugids is None:
+                bugids = bugid_history(ui, repo, pending)
+            self.repo_bugids = bugids
         self.blacklist = dict.fromkeys(changeset_blacklist)
         self.read_blacklist(blacklist_file)
         # hg < 1.0 does not have localrepo.tagtype()
         self.tagtype = getattr(self.repo, 'tagtype', lambda k: 'global')
+        self.trusted = None
+        paths = ui.configlist("jcheck", "trusted")
+        if paths:
+            self.trusted = trusted_nodes(ui, paths)
 
     def read_blacklist(self, fname):
         if not os.path.exists(fname):
@@ -553,6 +1195,65 @@ class checker(object):
                 self.blacklist[l[0]] = len(l) == 2 and l[1] or None
         f.close()
 
+    def fingerprint(self):
+        # Identify everything besides the changeset and the repository
+        # history that a verdict depends upon
+        return hashlib.sha1(repr((_version, _date, self.strict, self.lax,
+                                  sorted(self.conf.items()),
+                                  [c.name for c in self.checks],
+                                  sorted(self.blacklist.keys()),
+                                  changeset_whitelist,
+                                  self.trusted and self.trusted.paths,
+                                  [(n, fm.pattern, tre.pattern)
+                                   for n, fm, tre in self.headers]))
+                            ).hexdigest()[:16]
+
+    def load_verdicts(self):
+        # Verdicts depend on the revisions before their changesets, so the
+        # file is ignored if history up to the last revision it covers has
+        # been rewritten
+        self.verdicts = { }
+        self.verdict_key = self.fingerprint()
+        last, f = read_revmark(self.repo, "verdicts")
+        if not f:
+            return
+        try:
+            for ln in f:
+                l = ln.split(" ", 2)
+                if (len(l) < 3 or l[1] != self.verdict_key
+                    or not ln.endswith("\n")):
+                    continue
+                try:
+                    self.verdicts[bin(l[0])] = [m.encode("utf-8")
+                                                for m in json.loads(l[2])]
+                except (TypeError, ValueError):
+                    pass
+        finally:
+            f.close()
+
+    def record_verdict(self, node):
+        # Authors may yet be added to the database, so a verdict rejecting
+        # one is not kept
+        if self.cs_unknown_authors:
+            return
+        try:
+            json.dumps(self.result.errors)
+        except UnicodeDecodeError:
+            return
+        self.verdicts[node] = list(self.result.errors)
+
+    def write_verdicts(self, upto):
+        # Replace the verdicts file with the verdicts under the current key,
+        # dropping those recorded under any other, as covering revisions up
+        # to upto
+        if self.verdicts is None:
+            self.load_verdicts()
+        lns = ["%d %s\n" % (upto, hex(self.repo.changelog.node(upto)))]
+        for node, errors in self.verdicts.iteritems():
+            lns.append("%s %s %s\n" % (hex(node), self.verdict_key,
+                                       json.dumps(errors)))
+        write_cache(self.repo, "verdicts", "".join(lns))
+
     def summarize(self, ctx):
         self.ui.status("\n")
         self.ui.status("> Changeset: %d:%s\n" % (ctx.rev(), short(ctx.node())))
@@ -563,19 +1264,25 @@ class checker(object):
         self.ui.status("\n\n")
 
     def error(self, ctx, msg):
-        if self.rv != Fail:
-            self.ui.status("[jcheck %s %s]\n" % (_version, _date))
-        if not self.summarized:
-            if ctx:
-                self.summarize(ctx)
-            else:
-                self.ui.status("\n")
-            self.summarized = True
-        self.ui.status(msg + "\n")
+        self.result.errors.append(msg)
+        if not self.quiet:
+            if self.rv != Fail:
+                self.ui.status("[jcheck %s %s]\n" % (_version, _date))
+            if not self.summarized:
+                if ctx:
+                    self.summarize(ctx)
+                else:
+                    self.ui.status("\n")
+                self.summarized = True
+            self.ui.status(msg + "\n")
         self.rv = Fail
+        if ctx:
+            self.cs_failed = True
 
     def c_00_author(self, ctx):
-        if not validate_author(self.ui, ctx.user(), self.conf["project"]):
+        if not validate_author(self.ui, ctx.user(), self.conf["project"],
+                               self.repo):
+            self.cs_unknown_authors = True
             self.error(ctx, "Invalid changeset author: %s" % ctx.user())
         self.cs_author = ctx.user()
 
@@ -644,29 +1351,84 @@ class checker(object):
             if (i < len(lns)):
                 self.error(ctx, "Extraneous text in comment")
 
+    def changed_files(self, ctx, match):
+        # Return (file, filenode) pairs for the files added or modified by
+        # ctx and accepted by match; the filenode is None if it must be
+        # looked up in the manifest.  Merges, and strict checks, diff the
+        # full manifests against the first parent.  Otherwise the file list
+        # recorded in the changelog is used, and a file is taken to be
+        # removed if no filelog revision introduced by ctx is found and it is
+        # not in its manifest (which is consulted only for removals, flag
+        # changes, reverts and out-of-order linkrevs).  Files are matched before they are looked up, and
+        # lookups are kept for the other checks of the changeset.
+        if self.cs_files is None:
+            if self.strict or is_merge(self.repo, ctx.rev()):
+                status = self.repo.status(ctx.parents()[0].node(), ctx.node(),
+                                          None)
+                modified, added = tuple(status)[:2]
+                # ## Skip files that were renamed but not modified
+                self.cs_files = modified + added
+                self.cs_filenodes = dict.fromkeys(self.cs_files)
+            else:
+                self.cs_files = ctx.files()
+        files = [ ]
+        for f in self.cs_files:
+            if not match(f):
+                continue
+            if not self.cs_filenodes.has_key(f):
+                fn = linked_filenode(self.repo.file(f), ctx.rev())
+                if fn is None and not f in ctx:
+                    fn = False          # Removed
+                self.cs_filenodes[f] = fn
+            if self.cs_filenodes[f] is not False:
+                files.append((f, self.cs_filenodes[f]))
+        return files
+
+    def scan_files(self, ctx, files, scan):
+        # Return a dictionary mapping each of the given (file, filenode) pairs
+        # to the result of scan(file, data), by file.  With more than one
+        # thread configured, the filenodes are looked up here and the files
+        # read and scanned concurrently.
+        if self.threads < 2 or len(files) < 2:
+            return dict([(f, scan(f, ctx.filectx(f, fileid=fn).data()))
+                         for f, fn in files])
+        files = [(f, fn or ctx.filectx(f).filenode()) for f, fn in files]
+        def read(ffn):
+            # Each thread opens its own filelogs, which are not thread-safe
+            return scan(ffn[0], self.repo.file(ffn[0]).read(ffn[1]))
+        return dict(zip([f for f, fn in files],
+                        parallel_map(read, files, self.threads)))
+
     def c_02_files(self, ctx):
-        status = self.repo.status(ctx.parents()[0].node(), ctx.node(), None)
-        modified, added = tuple(status)[:2]
-        # ## Skip files that were renamed but not modified
-        files = modified + added
+        if ctx.rev() == 0:
+            files = self.changed_files(ctx, self.initial_paths)
+        else:
+            files = self.changed_files(ctx, self.files_paths)
         if self.ui.debugflag:
-            self.ui.debug("Checking files: %s\n" % ", ".join(files))
-        for f in files:
-            if ctx.rev() == 0:
-                ## This is loathsome
-                if f.startswith("test/java/rmi"): continue
-                if f.startswith("test/com/sun/javadoc/test"): continue
-                if f.startswith("docs/technotes/guides"): continue
-            fx = ctx.filectx(f)
-            if normext_re.match(f) and not self.whitespace_lax:
-                data = fx.data()
-                if "\t" in data or "\r" in data or " \n" in data:
-                    m = badwhite_re.search(data)
-                    if m:
-                        ln = data.count("\n", 0, m.start()) + 1
-                        self.error(ctx, "%s:%d: %s" % (f, ln, badwhite_what(m)))
-            ## check_file_header(self, fx, data)
-            flags = fx.manifest().flags(f)
+            self.ui.debug("Checking files: %s\n"
+                          % ", ".join([f for f, fn in files]))
+        def scan(f, data):
+            # Keep the heads of files to be checked by c_04_header, so that
+            # it need not read them again
+            head = None
+            if self.header_rules(f):
+                head = data[:header_size]
+            return badwhite_scan(data), head
+        scanned = { }
+        if not self.whitespace_lax:
+            scanned = self.scan_files(ctx, [(f, fn) for f, fn in files
+                                            if self.whitespace_paths(f)],
+                                       scan)
+        for f, fn in files:
+            bw, head = scanned.get(f, (None, None))
+            if bw:
+                self.error(ctx, "%s:%d: %s" % (f, bw[0], bw[1]))
+            if head is not None:
+                self.cs_heads[f] = head
+            if hasattr(ctx, 'flags'):
+                flags = ctx.flags(f)
+            else:
+                flags = ctx.filectx(f, fileid=fn).manifest().flags(f)
             if 'x' in flags:
                 self.error(ctx, "%s: Executable files not permitted" % f)
             if 'l' in flags:
@@ -677,12 +1439,42 @@ class checker(object):
         if hash in self.blacklist:
             self.error(ctx, "Blacklisted changeset: " + hash)
 
-    def check(self, rev, node):
+    def header_rules(self, f):
+        if not self.header_paths(f):
+            return [ ]
+        return [(name, tre) for name, fm, tre in self.headers if fm(f)]
+
+    def c_04_header(self, ctx):
+        if not self.headers:
+            return
+        files = self.changed_files(ctx, self.header_rules)
+        heads = self.scan_files(ctx, [(f, fn) for f, fn in files
+                                      if not f in self.cs_heads],
+                                lambda f, data: data[:header_size])
+        heads.update(self.cs_heads)
+        for f, fn in files:
+            for name, tre in self.header_rules(f):
+                if not tre.search(heads[f]):
+                    self.error(ctx, "%s: Missing or incorrect %s header"
+                               % (f, name))
+
+    def start(self, rev, node):
+        # Forget the state of the previous changeset
         self.summarized = False
         self.cs_bugids = [ ]
         self.cs_author = None
         self.cs_reviewers = [ ]
         self.cs_contributor = None
+        self.cs_files = None
+        self.cs_filenodes = { }
+        self.cs_heads = { }
+        self.cs_failed = False
+        self.cs_deferred = False
+        self.cs_unknown_authors = False
+        self.result = Result(rev, node)
+
+    def check(self, rev, node):
+        self.start(rev, node)
         try:
             ctx = context.changectx(self.repo, node)
         except TypeError:
@@ -690,13 +1482,44 @@ class checker(object):
         self.ui.note(oneline(ctx))
         if hex(node) in changeset_whitelist:
             self.ui.note("%s in whitelist; skipping\n" % hex(node))
+            self.result.skipped = "whitelist"
             return Pass
+        # Merges are always checked, since they are created locally, and
+        # blacklisted changesets are rejected even if trusted, since they
+        # are just those that got into some repository but must spread no
+        # further
+        if (self.trusted and not is_merge(self.repo, ctx.rev())
+            and node in self.trusted):
+            self.ui.note("%s in trusted repository; skipping\n" % hex(node))
+            self.result.skipped = "trusted"
+            for c in self.checks:
+                if c.name == "hash":
+                    c.func(self, ctx)
+            return self.rv
+        # Pending changesets cannot have been checked before
+        if self.pending is None or rev < self.pending:
+            if self.verdicts is None:
+                self.load_verdicts()
+            if node in self.verdicts:
+                self.ui.note("%s already checked\n" % short(node))
+                for msg in self.verdicts[node]:
+                    self.error(ctx, msg)
+                return self.rv
         for c in self.checks:
-            cf = checker.__dict__[c]
-            cf(self, ctx)
+            if self.cs_failed and self.failfast:
+                self.ui.debug("%s failed; skipping remaining checks\n"
+                              % short(node))
+                break
+            if self.cs_deferred and self.failfast:
+                # Where merging would stop, should a deferred check fail
+                self.result.errors.append({ "failfast" : True })
+            c.func(self, ctx)
+        if self.record:
+            self.record_verdict(node)
         return self.rv
 
     def check_repo(self):
+        self.result = Result(None, None)
 
         if not self.tags_lax:
             ts = self.repo.tags().keys()
@@ -738,6 +1561,20 @@ class checker(object):
 
         return self.rv
 
+register_check("author", checker.c_00_author)
+register_check("comment", checker.c_01_comment)
+register_check("files", checker.c_02_files, needs=NEEDS_CONTENTS)
+register_check("hash", checker.c_03_hash)
+register_check("header", checker.c_04_header, needs=NEEDS_CONTENTS)
+
+
+def new_checker(ui, repo, opts, pending=None, bugids=None):
+    strict = opts.has_key("strict") and opts["strict"]
+    lax = opts.has_key("lax") and opts["lax"]
+    if strict:
+        lax = False
+    return checker(ui, repo, strict, lax, pending, bugids)
+
 
 def hook(ui, repo, hooktype, node=None, source=None, **opts):
     ui.debug("jcheck: node %s, source %s, args %s\n" % (node, source, opts))
@@ -747,14 +1584,10 @@ def hook(ui, repo, hooktype, node=None, source=None, **opts):
     if not os.path.exists(os.path.join(repo.root, ".jcheck")):
         ui.note("jcheck not enabled (no .jcheck in repository root); skipping\n")
         return Pass
-    strict = opts.has_key("strict") and opts["strict"]
-    lax = opts.has_key("lax") and opts["lax"]
-    if strict:
-        lax = False
-    ch = checker(ui, repo, strict, lax)
-    ch.check_repo()
     firstnode = bin(node)
     start = repo.changelog.rev(firstnode)
+    ch = new_checker(ui, repo, opts, pending=start)
+    ch.check_repo()
     end = (hasattr(repo.changelog, 'count') and repo.changelog.count() or
            len(repo.changelog))
     for rev in xrange(start, end):
@@ -764,12 +1597,352 @@ def hook(ui, repo, hooktype, node=None, source=None, **opts):
     return ch.rv
 
 
+# In-process API
+#
+# check_revisions() checks any number of revisions with a single checker,
+# so that the author list and bugid history are loaded only once, and
+# returns the findings as Result objects: first the repository-level
+# findings, then one per revision, in the order given.  Each revision may be
+# anything that repo[] accepts.  The options are those of the jcheck command
+# ("strict", "lax"), plus "quiet" (default True) to suppress the usual
+# report on ui.
+
+def check_revisions(ui, repo, revs, options={}):
+    repocompat(repo)
+    if not repo.local():
+        raise error_Abort("repository '%s' is not local" % repo.path)
+    if not os.path.exists(os.path.join(repo.root, ".jcheck")):
+        raise error_Abort("jcheck not enabled (no .jcheck in repository root)")
+    ch = new_checker(ui, repo, options)
+    ch.quiet = options.get("quiet", True)
+    ch.check_repo()
+    results = [ch.result]
+    for r in revs:
+        ctx = repo[r]
+        ch.check(ctx.rev(), ctx.node())
+        results.append(ch.result)
+    return results
+
+
+# Audits
+#
+# "hg jcheck --audit FILE" checks the given revisions (by default, the whole
+# history) in revision order and streams the findings to FILE, one JSON
+# object per line: a header, the repository-level findings, and then those
+# of each failing changeset.  Rather than gathering all bugids up front, an
+# audit accumulates them as it goes, which gives the same duplicate-bugid
+# errors.  Every so often the audit writes a checkpoint (FILE.checkpoint)
+# holding the next revision, the accumulated bugids, whether anything has
+# failed so far, and the length of FILE at that point.  An interrupted audit,
+# run again with the same revisions and options, resumes from its checkpoint
+# with identical results.
+#
+# With --shard, an audit of an explicit range of revisions can be spread over
+# several processes or machines.  A shard records its reused-bugid checks
+# unresolved, and ends with the first revision of each bugid in its range.
+# "hg jcheck --audit FILE --merge SHARD..." then resolves those checks in
+# revision order and writes the report that a single audit of the combined
+# range would have written.  The shards must cover consecutive ranges
+# starting at revision 0, each starting after the same changeset as ended
+# the one before, so that clones with a different revision order are not
+# mixed.
+
+audit_checkpoint_revs = 1000            # Checkpoint interval, in revisions
+audit_checkpoint_secs = 60              # ... and in seconds
+
+def audit_revs(repo, opts):
+    from mercurial import scmutil
+    return sorted(scmutil.revrange(repo, opts["rev"] or ["0:tip"]))
+
+def audit_line(obj):
+    return json.dumps(obj, sort_keys=True) + "\n"
+
+def audit_result(res):
+    errors = [ ]
+    for m in res.errors:
+        if isinstance(m, str):
+            m = m.decode("utf-8", "replace")
+        errors.append(m)
+    return audit_line({ "rev" : res.rev,
+                        "node" : res.node and hex(res.node),
+                        "errors" : errors })
+
+def audit_header(revs, ch, shard):
+    # Revision numbers differ between clones, so the header also records
+    # the nodes of the audited range, and a shard that of the revision
+    # before it, which must be the last of the preceding shard
+    cl = ch.repo.changelog
+    hdr = { "jcheck" : "%s %s" % (_version, _date),
+            "first" : revs[0], "last" : revs[-1], "config" : ch.fingerprint(),
+            "first_node" : hex(cl.node(revs[0])),
+            "last_node" : hex(cl.node(revs[-1])) }
+    if shard:
+        hdr["shard"] = True
+        hdr["parent_node"] = hex(revs[0] > 0 and cl.node(revs[0] - 1)
+                                 or nullid)
+    return audit_line(hdr)
+
+def read_checkpoint(repo, fn, key):
+    try:
+        f = open(fn)
+        try:
+            cp = json.load(f)
+        finally:
+            f.close()
+    except (IOError, ValueError):
+        return None
+    last = cp.get("next", 0) - 1
+    if (cp.get("key") != key or last >= len(repo)
+        or (last >= 0 and hex(repo.changelog.node(last)) != cp.get("node"))):
+        return None
+    return cp
+
+def write_checkpoint(repo, fn, key, next, offset, failed, bugids):
+    cp = { "key" : key, "next" : next, "offset" : offset, "failed" : failed,
+           "node" : next > 0 and hex(repo.changelog.node(next - 1)) or None,
+           "bugids" : bugids }
+    tmp = fn + ".tmp"
+    f = open(tmp, "w")
+    try:
+        json.dump(cp, f)
+    finally:
+        f.close()
+    os.rename(tmp, fn)
+
+def audit(ui, repo, opts):
+    fn = opts["audit"]
+    cfn = fn + ".checkpoint"
+    revs = audit_revs(repo, opts)
+    if not revs:
+        raise error_Abort("no revisions to audit")
+    shard = opts.get("shard")
+    bugids = { }
+    ch = new_checker(ui, repo, opts, bugids=bugids)
+    ch.quiet = True
+    ch.defer_bugids = shard
+    key = hashlib.sha1(repr((revs, shard, ch.fingerprint()))).hexdigest()
+    cp = read_checkpoint(repo, cfn, key)
+    if cp and (not os.path.exists(fn) or os.path.getsize(fn) < cp["offset"]):
+        ui.status("findings of interrupted audit are missing; starting over\n")
+        cp = None
+    if cp:
+        start = cp["next"]
+        for b, r in cp["bugids"].iteritems():
+            bugids[int(b)] = r
+        if cp["failed"]:
+            ch.rv = Fail
+        ui.status("resuming audit at revision %d\n" % start)
+        out = open(fn, "r+")
+        out.truncate(cp["offset"])
+        out.seek(cp["offset"])
+    else:
+        start = 0
+        if shard:
+            start = revs[0]
+        out = open(fn, "w")
+        out.write(audit_header(revs, ch, shard))
+        ch.check_repo()
+        out.write(audit_result(ch.result))
+    wanted = set(revs)
+    n = 0
+    t = time.time()
+    try:
+        for rev in xrange(start, revs[-1] + 1):
+            ctx = repo[rev]
+            if rev in wanted:
+                ch.check(rev, ctx.node())
+                if ch.result.failed():
+                    out.write(audit_result(ch.result))
+            add_bugids(bugids, ctx)
+            n += 1
+            if (n % audit_checkpoint_revs == 0
+                or time.time() - t > audit_checkpoint_secs):
+                out.flush()
+                os.fsync(out.fileno())
+                write_checkpoint(repo, cfn, key, rev + 1, out.tell(),
+                                 ch.rv == Fail, bugids)
+                ui.note("audit checkpoint at revision %d\n" % rev)
+                t = time.time()
+        if shard:
+            out.write(audit_line({ "bugids" : bugids }))
+    finally:
+        out.close()
+    if os.path.exists(cfn):
+        os.unlink(cfn)
+    ui.status("audited %d changesets; findings in %s\n" % (len(revs), fn))
+    return ch.rv
+
+def read_shard(fn):
+    # Return the header and the bugids of a shard
+    f = open(fn)
+    try:
+        hdr = json.loads(f.readline())
+        bugids = None
+        for ln in f:
+            if ln.startswith('{"bugids": '):
+                bugids = json.loads(ln)["bugids"]
+    finally:
+        f.close()
+    if not hdr.get("shard") or bugids is None:
+        raise error_Abort("%s: not a complete audit shard" % fn)
+    return hdr, dict([(int(b), r) for b, r in bugids.iteritems()])
+
+def merge_audits(ui, fn, shard_fns):
+    shards = [read_shard(sfn) + (sfn,) for sfn in shard_fns]
+    shards.sort(key=lambda s: s[0]["first"])
+    next = 0
+    parent = hex(nullid)
+    for hdr, bugids, sfn in shards:
+        if hdr["first"] != next:
+            raise error_Abort("%s: shards must cover consecutive revisions"
+                              " from 0; expected revision %d" % (sfn, next))
+        if hdr.get("parent_node") != parent:
+            raise error_Abort("%s: shard does not follow on from changeset %s;"
+                              " were the shards audited in clones with a"
+                              " different revision order?" % (sfn, parent[:12]))
+        if (hdr["jcheck"] != shards[0][0]["jcheck"]
+            or hdr["config"] != shards[0][0]["config"]):
+            raise error_Abort("%s: shard has a different jcheck version or"
+                              " configuration" % sfn)
+        next = hdr["last"] + 1
+        parent = hdr["last_node"]
+    hdr = dict(shards[0][0])
+    del hdr["shard"]
+    del hdr["parent_node"]
+    hdr["last"] = shards[-1][0]["last"]
+    hdr["last_node"] = shards[-1][0]["last_node"]
+    seen = { }                          # bugid -> rev, from earlier shards
+    rv = Pass
+    out = open(fn, "w")
+    try:
+        out.write(audit_line(hdr))
+        for i in xrange(len(shards)):
+            shdr, bugids, sfn = shards[i]
+            f = open(sfn)
+            try:
+                f.readline()
+                for ln in f:
+                    res = json.loads(ln)
+                    if not "errors" in res:
+                        continue
+                    if res["rev"] is None and i > 0:
+                        continue        # Repository findings, from shard 0
+                    errors = [ ]
+                    for m in res["errors"]:
+                        if isinstance(m, dict) and "failfast" in m:
+                            if errors:
+                                break
+                        elif isinstance(m, dict):
+                            b = m["bugid"]
+                            r = seen.get(b, bugids.get(b))
+                            if r is not None and r < res["rev"]:
+                                errors.append(bugid_reused(b, r))
+                        else:
+                            errors.append(m)
+                    if errors or res["rev"] is None:
+                        res["errors"] = errors
+                        out.write(audit_line(res))
+                    if errors:
+                        rv = Fail
+            finally:
+                f.close()
+            for b, r in bugids.iteritems():
+                if not b in seen:
+                    seen[b] = r
+    finally:
+        out.close()
+    ui.status("merged %d shards; findings in %s\n" % (len(shards), fn))
+    return rv
+
+
 # Run this hook in repository gates
 
 def strict_hook(ui, repo, hooktype, node=None, source=None, **opts):
     opts["strict"] = True
     return hook(ui, repo, hooktype, node, source, **opts)
 
+# Cache warming
+#
+# warm_hook runs "hg jcheck --warm" in a detached background process, which
+# updates the bugid and author caches and pre-checks, recording verdicts, the
+# changesets committed since it last ran (the first time, those from the
+# hook's node onwards, except for clones).  strict_warm_hook pre-checks them
+# as strict_hook would, for repositories gated by it.  The verdicts file is
+# rewritten with only the verdicts of the warmer's configuration.  Warmers
+# run one at a time under the cache lock; a hook that finds one running
+# leaves a request for it to go round again once it is done.
+
+def warm(ui, repo, opts):
+    again = cache_path(repo, "warm.again")
+    while True:
+        if not lock_cache(repo):
+            ui.status("jcheck: cannot lock the cache; not warming\n")
+            return Pass
+        try:
+            if os.path.exists(again):
+                os.unlink(again)
+            try:
+                load_authors(ui, repo)
+            except IOError as e:
+                ui.warn("jcheck: cannot load author names: %s\n" % e)
+            repo_bugids(ui, repo)
+            bugid_filter(ui, repo)
+            ch = new_checker(ui, repo, opts)
+            ch.quiet = True
+            ch.record = True
+            last, f = read_revmark(repo, "warm")
+            if f:
+                f.close()
+                start = last + 1
+            elif opts["rev"]:
+                start = repo[opts["rev"][0]].rev()
+            else:
+                start = len(repo)
+            end = last_committed(repo) + 1
+            ui.debug("jcheck: warming revisions %d to %d\n" % (start, end - 1))
+            for rev in xrange(start, end):
+                ch.check(rev, repo.changelog.node(rev))
+            if end > 0:
+                ch.write_verdicts(end - 1)
+                write_cache(repo, "warm", "%d %s\n"
+                            % (end - 1, hex(repo.changelog.node(end - 1))))
+        finally:
+            unlock_cache(repo)
+        if not os.path.exists(again):
+            return Pass
+        repo.invalidate()
+
+def warm_hook(ui, repo, hooktype, node=None, source=None, **opts):
+    if fcntl is None or not os.path.exists(os.path.join(repo.root, ".jcheck")):
+        return Pass
+    write_cache(repo, "warm.again", "")
+    if not lock_cache(repo, wait=False):
+        return Pass                     # The running warmer will go again
+    unlock_cache(repo)
+    ext = os.path.abspath(__file__)
+    if ext.endswith(".pyc") or ext.endswith(".pyo"):
+        ext = ext[:-1]
+    args = [hgexecutable(), "--config", "extensions.jcheck=" + ext,
+            "-R", repo.root, "jcheck", "--warm"]
+    if opts.get("strict"):
+        args.append("--strict")
+    if node and source != "clone":
+        args += ["-r", node]
+    env = dict(os.environ)
+    env.pop("HG_PENDING", None)
+    null = open(os.devnull, "r+")
+    try:
+        subprocess.Popen(args, stdin=null, stdout=null, stderr=null,
+                         close_fds=True, preexec_fn=os.setsid, env=env)
+    finally:
+        null.close()
+    return Pass
+
+def strict_warm_hook(ui, repo, hooktype, node=None, source=None, **opts):
+    opts["strict"] = True
+    return warm_hook(ui, repo, hooktype, node, source, **opts)
+
+
 # From Mercurial 1.9, the preferred way to define commands is using the @command
 # decorator. If this isn't available, fallback on a simple local implementation
 # that just adds the data to the cmdtable.
@@ -787,28 +1960,42 @@ else:
 
 opts = [("", "lax", False, "Check comments, tags and whitespace laxly"),
         ("r", "rev", [], "check the specified revision or range (default: tip)"),
-        ("s", "strict", False, "check everything")]
+        ("s", "strict", False, "check everything"),
+        ("", "warm", False, "update the caches and pre-check new changesets"),
+        ("", "audit", "", "audit the revisions (default: all) into a file"),
+        ("", "shard", False, "audit a shard, for merging with --merge"),
+        ("", "merge", False, "merge the given audit shards into a file")]
 
-help = "[-r rev] [-s]"
+help = "[-r rev] [-s] [--warm] [--audit file [--shard | --merge shard...]]"
 
 @command("jcheck", opts, "hg jcheck " + help)
-def jcheck(ui, repo, **opts):
+def jcheck(ui, repo, *shards, **opts):
     """check changesets against JDK standards"""
     ui.debug("jcheck repo=%s opts=%s\n" % (repo.path, opts))
+    if (opts.get("shard") or opts.get("merge")) and not opts.get("audit"):
+        raise error_Abort("--shard and --merge require --audit")
+    if opts.get("shard") and opts.get("merge"):
+        raise error_Abort("--shard and --merge are mutually exclusive")
+    if opts.get("merge") and not shards:
+        raise error_Abort("--merge requires the audit shards to merge")
+    if shards and not opts.get("merge"):
+        raise error_Abort("unexpected arguments: %s" % " ".join(shards))
     repocompat(repo)
     if not repo.local():
         raise error_Abort("repository '%s' is not local" % repo.path)
     if not os.path.exists(os.path.join(repo.root, ".jcheck")):
         ui.status("jcheck not enabled (no .jcheck in repository root)\n")
         return Pass
+    if opts.get("warm"):
+        return warm(ui, repo, opts)
+    if opts.get("audit") and opts.get("merge"):
+        return merge_audits(ui, opts["audit"], shards)
+    if opts.get("audit"):
+        return audit(ui, repo, opts)
     if len(opts["rev"]) == 0:
         opts["rev"] = ["tip"]
 
-    strict = opts.has_key("strict") and opts["strict"]
-    lax = opts.has_key("lax") and opts["lax"]
-    if strict:
-        lax = False
-    ch = checker(ui, repo, strict, lax)
+    ch = new_checker(ui, repo, opts)
     ch.check_repo()
 
     try:
@@ -24,7 +24,7 @@
 # Pseudo-extension for running jcheck unit tests
 # that require extraordinary configuration
 
-import sys, os, re, urllib, urllib2
+import sys, os, re, time, urllib, urllib2
 from mercurial.node import *
 from mercurial import cmdutil, patch, util, context, templater
 try:
@@ -71,3 +71,66 @@ def jcheck_test(ui, repo, **opts):
     del opts["white"]
     del opts["black"]
     return jcheck.jcheck(ui, repo, **opts)
+
+@command("jcheck_batch", jcheck.opts, "hg jcheck_batch " + jcheck.help)
+def jcheck_batch(ui, repo, **opts):
+    """check many revisions in one process, one line each (TESTING)"""
+    revs = opts["rev"]
+    del opts["rev"]
+    results = jcheck.check_revisions(ui, repo, revs, opts)
+    repo_errors = results[0].errors
+    for msg in repo_errors:
+        ui.write("    %s\n" % msg)
+    for res in results[1:]:
+        if res.failed() or repo_errors:
+            ui.write("%d fail\n" % res.rev)
+        else:
+            ui.write("%d pass\n" % res.rev)
+        for msg in res.errors:
+            ui.write("    %s\n" % msg)
+    return jcheck.Pass
+
+@command("jcheck_bench",
+         jcheck.opts + [("n", "iterations", 20, "number of timed iterations")],
+         "hg jcheck_bench [-n count] " + jcheck.help)
+def jcheck_bench(ui, repo, **opts):
+    """time the file checks of the given revisions (TESTING)"""
+    n = int(opts["iterations"])
+    revs = opts["rev"] or ["tip"]
+    ch = jcheck.new_checker(ui, repo, opts)
+    ch.quiet = True
+    elapsed = 0.0
+    for i in xrange(n):
+        # Start cold: drop the cached changelog, manifests and contexts
+        if hasattr(repo, 'invalidate'):
+            repo.invalidate()
+        for r in revs:
+            ctx = repo[r]
+            t = time.time()
+            ch.start(ctx.rev(), ctx.node())
+            ch.c_02_files(ctx)
+            elapsed += time.time() - t
+    ui.write("%.3f ms per changeset\n" % (elapsed * 1000 / (n * len(revs))))
+    return jcheck.Pass
+
+@command("jcheck_audit",
+         jcheck.opts + [("", "checkpoint-every", 0, "checkpoint interval"),
+                        ("", "interrupt-after", 0, "revisions to audit")],
+         "hg jcheck_audit [--checkpoint-every n] [--interrupt-after n] "
+         + jcheck.help)
+def jcheck_audit(ui, repo, **opts):
+    """audit revisions, simulating an interruption (TESTING)"""
+    if opts["checkpoint_every"]:
+        jcheck.audit_checkpoint_revs = int(opts["checkpoint_every"])
+    left = [int(opts["interrupt_after"])]
+    if left[0]:
+        add_bugids = jcheck.add_bugids
+        def interrupting_add_bugids(bugids, ctx):
+            left[0] -= 1
+            if left[0] < 0:
+                raise KeyboardInterrupt
+            add_bugids(bugids, ctx)
+        jcheck.add_bugids = interrupting_add_bugids
+    del opts["checkpoint_every"]
+    del opts["interrupt_after"]
+    return jcheck.jcheck(ui, repo, **opts)
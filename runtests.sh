@@ -22,11 +22,15 @@ fail() {
   if [ $FAILFIRST ]; then exit 2; fi
 }
 
-# Cases created by mktests
-
-r=0
-while [ $r -le $last ]; do
-  au=$(hg log -r $r --template '{author}')
+# Cases created by mktests, checked in-process by one jcheck_batch command
+# per mode rather than by one hg jcheck process per revision
+
+batch="hg --config extensions.jcheck_test=$(pwd)/jcheck_test.py jcheck_batch"
+revs=
+laxrevs=
+hg log -r 0:$last --template '{rev} {author}\n' >authors.out
+rm -f types.out
+while read r au; do
   lax=
   case $au in
     $pass_author) type=pass;;
@@ -36,19 +40,29 @@ while [ $r -le $last ]; do
     $setup_author) type=setup;;
     *) type=$au;;
   esac
+  echo "$r $type" >>types.out
+  if [ $type = setup ]; then continue; fi
+  if [ "$lax" ]; then laxrevs="$laxrevs -r $r"; else revs="$revs -r $r"; fi
+done <authors.out
+
+rm -f batch.out
+touch batch.out
+if [ "$revs" ]; then $batch $revs "$@" >>batch.out; fi
+if [ "$laxrevs" ]; then $batch --lax $laxrevs "$@" >>batch.out; fi
+
+# Repository-level findings come first, then each revision's result line
+# followed by its findings, indented
+awk '/^[^ ]/ { exit } { print }' batch.out
+while read r type; do
   echo "-- $r $type"
-  if [ $type = setup ]; then
-    r=$(expr $r + 1)
-    continue
-  fi
-  hg jcheck $lax -r $r "$@"
-  rv=$?
+  awk -v r=$r '/^[^ ]/ { p = ($1 == r) } p && /^ /' batch.out
   case $type in
-    pass) if [ $rv != 0 ]; then fail $r; fi;;
-    fail|fang) if [ $rv = 0 ]; then fail $r; fi;;
+    pass) if grep -q "^$r pass$" batch.out; then true; else fail $r; fi;;
+    fail|fang) if grep -q "^$r fail$" batch.out; then true; else fail $r; fi;;
   esac
-  r=$(expr $r + 1)
-done
+done <types.out
+rm -f authors.out types.out batch.out
+r=$(expr $last + 1)
 
 # Cases that require richer logic
 
@@ -345,6 +359,291 @@ Reviewed-by: fang"
 if [ $? -eq 0 ]; then fail; fi
 r=$(expr $r + 1)
 
+# Trusted reference repositories
+echo "-- $r trusted repository"
+rm -rf z z2
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+___
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m 'Bad comment, already upstream' -d '0 0'
+hg clone -q z z2
+cp z/.hg/hgrc z2/.hg
+if hg jcheck -R z2 -r tip; then fail; fi
+if hg jcheck -R z2 -r tip --config jcheck.trusted=$(pwd)/z; then true; else fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r trusted node list"
+hg log -R z --template '{node}\n' >z.nodes
+if hg jcheck -R z2 -r tip --config jcheck.trusted=$(pwd)/z.nodes; then true; else fail; fi
+echo 'not-a-node' >>z.nodes
+if hg jcheck -R z2 -r tip --config jcheck.trusted=$(pwd)/z.nodes 2>&1 \
+   | grep -q 'z.nodes:[0-9]*: Invalid changeset id: not-a-node'; then true; else fail; fi
+if hg jcheck -R z2 -r tip --config jcheck.trusted=$(pwd)/z.missing 2>&1 \
+   | grep -q 'abort: \[jcheck\] trusted: .*z.missing'; then true; else fail; fi
+mkdir z.notrepo
+if hg jcheck -R z2 -r tip --config jcheck.trusted=$(pwd)/z.notrepo 2>&1 \
+   | grep -q 'abort: \[jcheck\] trusted: .*z.notrepo'; then true; else fail; fi
+rm -rf z2 z.nodes z.notrepo
+r=$(expr $r + 1)
+
+# Check toggles
+echo "-- $r disabled check"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+cat >z/.jcheck/conf <<___
+project=jdk7
+checks.files=off
+___
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+___
+hg add -R z z/.jcheck/conf
+touch z/executable
+chmod +x z/executable
+hg add -R z z/executable
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+if hg jcheck -R z -r tip; then true; else fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r failfast"
+cat >z/.jcheck/conf <<___
+project=jdk7
+failfast=true
+___
+if hg jcheck -R z -r tip >z/log; then fail; fi
+if grep -q 'Executable files' z/log; then true; else fail; fi
+echo foo >z/executable
+HGUSER=$setup_author hg ci -R z -m 'Bad comment' -d '0 0'
+if hg jcheck -R z -r tip >z/log; then fail; fi
+if grep -q 'Executable files' z/log; then fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r unknown check"
+echo 'checks.nosuchcheck=off' >>z/.jcheck/conf
+if hg jcheck -R z -r tip; then fail; fi
+r=$(expr $r + 1)
+
+# Cache warming
+echo "-- $r warm caches"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+[hooks]
+post-commit.jcheck = python:jcheck.warm_hook
+___
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+i=0
+while [ ! -f z/.hg/jcheck/warm -a $i -lt 60 ]; do sleep 1; i=$(expr $i + 1); done
+if [ -f z/.hg/jcheck/bugids -a -f z/.hg/jcheck/authors ]; then true; else fail; fi
+if hg jcheck -v -R z -r tip | grep -q 'already checked'; then true; else fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r strict warm caches"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+[hooks]
+post-commit.jcheck = python:jcheck.strict_warm_hook
+___
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+i=0
+while [ ! -f z/.hg/jcheck/warm -a $i -lt 60 ]; do sleep 1; i=$(expr $i + 1); done
+if hg jcheck -v -R z -r tip --strict | grep -q 'already checked'; then true; else fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r read-only caches"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+echo "[extensions]
+jcheck = $(pwd)/jcheck.py" >z/.hg/hgrc
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+chmod a-w z/.hg
+if hg jcheck -R z -r tip; then true; else fail; fi
+chmod u+w z/.hg
+r=$(expr $r + 1)
+
+# Threaded file reads
+echo "-- $r threaded file reads"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+___
+for f in a b c d e f g h; do echo "class $f { }" >z/$f.java; done
+echo 'trailing ' >z/c.java
+echo '	tab' >z/f.java
+hg add -R z z/.jcheck/conf z/*.java
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+hg jcheck -R z -r tip >z/log.1
+hg jcheck -R z -r tip --config jcheck.threads=4 >z/log.4
+if grep -q 'c.java:1: Trailing whitespace' z/log.4 \
+   && grep -q 'f.java:1: Tab character' z/log.4 \
+   && cmp -s z/log.1 z/log.4; then true; else fail; fi
+r=$(expr $r + 1)
+
+# Audits
+echo "-- $r resumed audit"
+audit="hg --config extensions.jcheck_test=$(pwd)/jcheck_test.py jcheck_audit"
+rm -f audit.*
+hg jcheck --audit audit.1 -r 0:$last
+$audit --checkpoint-every 10 --interrupt-after 25 --audit audit.2 -r 0:$last
+if [ -f audit.2.checkpoint ]; then true; else fail; fi
+hg jcheck --audit audit.2 -r 0:$last
+if cmp -s audit.1 audit.2 && [ ! -f audit.2.checkpoint ]; then true; else fail; fi
+$audit --checkpoint-every 10 --interrupt-after 25 --audit audit.3 -r 0:$last
+rm -f audit.3
+hg jcheck --audit audit.3 -r 0:$last
+if cmp -s audit.1 audit.3 && [ ! -f audit.3.checkpoint ]; then true; else fail; fi
+rm -f audit.*
+r=$(expr $r + 1)
+
+echo "-- $r sharded audit"
+rm -f audit.*
+hg jcheck --audit audit.1 -r 0:$last
+m1=$(expr $last / 3)
+m2=$(expr $m1 \* 2)
+hg jcheck --audit audit.s2 --shard -r $(expr $m1 + 1):$m2 &
+hg jcheck --audit audit.s3 --shard -r $(expr $m2 + 1):$last &
+hg jcheck --audit audit.s1 --shard -r 0:$m1
+wait
+hg jcheck --audit audit.2 --merge audit.s3 audit.s1 audit.s2
+if cmp -s audit.1 audit.2; then true; else fail; fi
+if hg jcheck --audit audit.3 --merge audit.s1 audit.s3; then fail; fi
+sed -e 's/"parent_node": "[0-9a-f]*"/"parent_node": "'$(printf 'f%.0s' $(seq 40))'"/' \
+  audit.s2 >audit.s2x
+if hg jcheck --audit audit.3 --merge audit.s1 audit.s2x audit.s3; then fail; fi
+if hg jcheck --merge audit.s1 audit.s2 audit.s3; then fail; fi
+if hg jcheck --shard -r 0:$m1; then fail; fi
+if hg jcheck --audit audit.3 --shard --merge audit.s1; then fail; fi
+if hg jcheck -r tip audit.s1; then fail; fi
+rm -f audit.*
+r=$(expr $r + 1)
+
+echo "-- $r file header"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+cat >z/.jcheck/conf <<___
+project=jdk7
+header.gpl.files=*.java
+header.gpl.template=gpl
+___
+cat >z/.jcheck/gpl <<___
+/*
+ * Copyright (c) @YEARS@, Oracle and/or its affiliates. All rights reserved.
+ */
+___
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+___
+hg add -R z z/.jcheck/conf z/.jcheck/gpl
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+cat >z/Good.java <<___
+/*
+ * Copyright (c) 2007, 2011, Oracle and/or its affiliates. All rights reserved.
+ */
+class Good { }
+___
+hg add -R z z/Good.java
+HGUSER=$setup_author hg ci -R z -m '1111112: Bar!
+Reviewed-by: alanb' -d '0 0'
+if hg jcheck -R z -r tip; then true; else fail; fi
+echo 'class Bad { }' >z/Bad.java
+hg add -R z z/Bad.java
+HGUSER=$setup_author hg ci -R z -m '1111113: Baz!
+Reviewed-by: alanb' -d '0 0'
+if hg jcheck -R z -r tip; then fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r excluded paths"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+cat >z/.jcheck/conf <<___
+project=jdk7
+checks.files.exclude=src/3rdparty/,gen/*.c
+whitespace.exclude=**/Tabbed.java
+___
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+___
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+mkdir -p z/src/3rdparty/lib z/gen z/src/share
+touch z/src/3rdparty/lib/configure
+chmod +x z/src/3rdparty/lib/configure
+printf 'int x;\t\n' >z/gen/parser.c
+printf 'class Tabbed {\t}\n' >z/src/share/Tabbed.java
+hg add -R z z/src z/gen
+HGUSER=$setup_author hg ci -R z -m '1111112: Bar!
+Reviewed-by: alanb' -d '0 0'
+if hg jcheck -R z -r tip; then true; else fail; fi
+printf 'int y;\t\n' >z/src/share/parser.c
+hg add -R z z/src/share/parser.c
+HGUSER=$setup_author hg ci -R z -m '1111113: Baz!
+Reviewed-by: alanb' -d '0 0'
+if hg jcheck -R z -r tip; then fail; fi
+echo 'checks.hash.include=src/' >>z/.jcheck/conf
+if hg jcheck -R z -r 1; then fail; fi
+r=$(expr $r + 1)
+
+echo "-- $r bugid filter"
+rm -rf z
+hg init z
+mkdir z/.jcheck
+echo 'project=jdk7' >z/.jcheck/conf
+cat >z/.hg/hgrc <<___
+[extensions]
+jcheck = $(pwd)/jcheck.py
+[hooks]
+pretxncommit.jcheck=python:jcheck.hook
+___
+hg add -R z z/.jcheck/conf
+HGUSER=$setup_author hg ci -R z -m '1111111: Foo!
+Reviewed-by: alanb' -d '0 0'
+echo foo >z/foo
+hg add -R z z/foo
+if HGUSER=$setup_author hg ci --debug -R z -m '1111112: Bar!
+Reviewed-by: alanb' -d '0 0' 2>&1 | grep -q 'may have been used'; then fail; fi
+if [ -f z/.hg/jcheck/bugids.bloom ]; then true; else fail; fi
+echo bar >z/foo
+if HGUSER=$setup_author hg ci -R z -m '1111111: Foo again!
+Reviewed-by: alanb' -d '0 0' 2>&1 | grep -q 'Bugid 1111111 already used'; then true; else fail; fi
+if [ $(hg log -R z --template x | wc -c) -eq 2 ]; then true; else fail; fi
+r=$(expr $r + 1)
+
 # Summary
 
 if [ $failures -gt 0 ]; then